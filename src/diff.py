@@ -0,0 +1,373 @@
+import sys
+from bisect import bisect_left
+from hashlib import sha1
+from itertools import chain
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+
+from common import is_windows
+from file_system import git_dir
+from index import IndexObject, normalize_mode, parse_index, stream_object
+from worktree import match_patterns, tree_entries
+
+NULL_OID = '0' * 40
+
+MAX_CHAIN = 64  # Lines occurring more often than this are never used as anchors
+
+MAX_MYERS_COST = 1024  # Edit distance explored per Myers pass, which bounds its memory
+
+BINARY_CHECK_SIZE = 8000  # Same heuristic as Git: a NUL byte in the first 8000 bytes
+
+
+class LineInterner():
+    """Maps each distinct line to an integer id, so the diff compares ints instead of bytes."""
+
+    def __init__(self) -> None:
+        self.ids: Dict[bytes, int] = {}
+        self.lines: List[bytes] = []
+
+    def intern(self, lines: Iterable[bytes]) -> List[int]:
+        ids = self.ids
+        result = []
+        for line in lines:
+            if (i := ids.get(line)) is None:
+                i = ids[line] = len(self.lines)
+                self.lines.append(line)
+            result.append(i)
+        return result
+
+
+def stream_file(file: Path, chunksize=65536) -> Generator[bytes, None, None]:
+    with file.open(mode='rb') as f:
+        while (chunk := f.read(chunksize)):
+            yield chunk
+
+
+def split_lines(chunks: Iterable[bytes]) -> Generator[bytes, None, None]:
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def peek_binary(chunks: Iterable[bytes]) -> Tuple[bool, Iterable[bytes]]:
+    chunks = iter(chunks)
+    head = b''
+    while len(head) < BINARY_CHECK_SIZE and (chunk := next(chunks, None)) is not None:
+        head += chunk
+    return b'\x00' in head[:BINARY_CHECK_SIZE], chain([head], chunks)
+
+
+def hash_stream(chunks: Iterable[bytes], size: int, h) -> Generator[bytes, None, None]:
+    h.update(f'blob {size}\x00'.encode())
+    for chunk in chunks:
+        h.update(chunk)
+        yield chunk
+
+
+def rare_matches(a: List[int], b: List[int], a0: int, a1: int, b0: int, b1: int) -> Optional[List[Tuple[int, int, int]]]:
+    # Returns None when the region shares no line at all
+    occurrences: Dict[int, List[int]] = {}
+    for i in range(a0, a1):
+        occurrences.setdefault(a[i], []).append(i)
+
+    best = []
+    best_count = MAX_CHAIN + 1
+    shared = False
+    j = b0
+    while j < b1:
+        positions = occurrences.get(b[j])
+        shared = shared or positions is not None
+        if positions is None or len(positions) > min(best_count, MAX_CHAIN):
+            j += 1
+            continue
+        next_j = j + 1
+        for i in positions:
+            # Extend the match both ways, tracking the rarest line inside it
+            count = len(positions)
+            si, sj = i, j
+            while si > a0 and sj > b0 and a[si - 1] == b[sj - 1]:
+                si, sj = si - 1, sj - 1
+                count = min(count, len(occurrences[a[si]]))
+            ei, ej = i + 1, j + 1
+            while ei < a1 and ej < b1 and a[ei] == b[ej]:
+                count = min(count, len(occurrences[a[ei]]))
+                ei, ej = ei + 1, ej + 1
+            if count < best_count:
+                best, best_count = [(si, sj, ei - si)], count
+            elif count == best_count:
+                best.append((si, sj, ei - si))
+            next_j = max(next_j, ej)
+        j = next_j
+
+    if not shared:
+        return None
+    if best_count > 1:
+        return [max(best, key=lambda m: m[2])] if best else []
+    return increasing_chain(best)
+
+
+def increasing_chain(matches: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    # Matches around unique lines arrive ordered in b; keep the longest run ordered in a too
+    tails: List[int] = []
+    tail_index: List[int] = []
+    prev = [-1] * len(matches)
+    for k, (i, _, _) in enumerate(matches):
+        pos = bisect_left(tails, i)
+        if pos == len(tails):
+            tails.append(i)
+            tail_index.append(k)
+        else:
+            tails[pos] = i
+            tail_index[pos] = k
+        prev[k] = tail_index[pos - 1] if pos else -1
+    chain = []
+    k = tail_index[-1] if tail_index else -1
+    while k >= 0:
+        chain.append(matches[k])
+        k = prev[k]
+    chain.reverse()
+
+    result = []
+    for i, j, n in chain:
+        if not result or (i >= result[-1][0] + result[-1][2] and j >= result[-1][1] + result[-1][2]):
+            result.append((i, j, n))
+    return result
+
+
+def myers_matches(a: List[int], b: List[int], a0: int, a1: int, b0: int, b1: int) -> Tuple[List[Tuple[int, int, int]], int, int]:
+    """Myers' O(ND) diff of a region, for lines too common to anchor a histogram split.
+
+    Returns the matching blocks and how far (x, y) into the region they reach. When the
+    edit distance exceeds MAX_MYERS_COST, the furthest reaching path found so far is
+    returned and the caller diffs the rest of the region separately.
+    """
+    n, m = a1 - a0, b1 - b0
+    v = {1: 0}
+    trace = []
+    end = None
+    for d in range(min(n + m, MAX_MYERS_COST) + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            x = v[k + 1] if k == -d or (k != d and v[k - 1] < v[k + 1]) else v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x, y = x + 1, y + 1
+            v[k] = x
+            if x >= n and y >= m:
+                end = (x, y)
+                break
+        if end is not None:
+            break
+    if end is None:
+        # Furthest along x + y, among the diagonals that are still inside the region
+        k = max((k for k in range(-d, d + 1, 2) if v[k] <= n and v[k] - k <= m), key=lambda k: 2 * v[k] - k)
+        end = (v[k], v[k] - k)
+
+    blocks = []
+    x, y = end
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        prev_k = k + 1 if k == -d or (k != d and v[k - 1] < v[k + 1]) else k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        n = 0
+        while x > prev_x and y > prev_y:
+            x, y, n = x - 1, y - 1, n + 1
+        if n:
+            blocks.append((a0 + x, b0 + y, n))
+        x, y = prev_x, prev_y
+    blocks.reverse()
+    return blocks, end[0], end[1]
+
+
+def histogram_diff(a: List[int], b: List[int]) -> List[Tuple[int, int, int]]:
+    """Return the matching blocks (i, j, n) of two id sequences, sorted.
+
+    Regions are split around the rarest shared lines, as in Git's histogram
+    diff; when those are unique to both sides every such match is used at once,
+    as in patience diff. Regions whose shared lines are all more common than
+    MAX_CHAIN fall back to Myers' diff, as Git does.
+    """
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+        n = 0
+        while a0 + n < a1 and b0 + n < b1 and a[a0 + n] == b[b0 + n]:
+            n += 1
+        if n:
+            blocks.append((a0, b0, n))
+            a0, b0 = a0 + n, b0 + n
+        n = 0
+        while a1 - n > a0 and b1 - n > b0 and a[a1 - n - 1] == b[b1 - n - 1]:
+            n += 1
+        if n:
+            blocks.append((a1 - n, b1 - n, n))
+            a1, b1 = a1 - n, b1 - n
+        if a0 == a1 or b0 == b1:
+            continue
+        if (matches := rare_matches(a, b, a0, a1, b0, b1)) is None:
+            continue
+        if not matches:
+            found, x, y = myers_matches(a, b, a0, a1, b0, b1)
+            blocks.extend(found)
+            if (a0 + x, b0 + y) != (a1, b1):
+                stack.append((a0 + x, a1, b0 + y, b1))
+            continue
+        for i, j, n in matches:
+            blocks.append((i, j, n))
+            stack.append((a0, i, b0, j))
+            a0, b0 = i + n, j + n
+        stack.append((a0, a1, b0, b1))
+    blocks.sort()
+    return blocks
+
+
+def grouped_changes(blocks: List[Tuple[int, int, int]], len_a: int, len_b: int, context=3) -> Generator[Tuple[int, int, int, int, List], None, None]:
+    changes = []
+    i = j = 0
+    for bi, bj, n in blocks + [(len_a, len_b, 0)]:
+        if i < bi or j < bj:
+            changes.append((i, bi, j, bj))
+        i, j = bi + n, bj + n
+
+    group = []
+    for change in changes:
+        if group and change[0] - group[-1][1] > 2 * context:
+            yield hunk_range(group, len_a, context)
+            group = []
+        group.append(change)
+    if group:
+        yield hunk_range(group, len_a, context)
+
+
+def hunk_range(group: List, len_a: int, context: int) -> Tuple[int, int, int, int, List]:
+    start_a = max(0, group[0][0] - context)
+    end_a = min(len_a, group[-1][1] + context)
+    start_b = group[0][2] - (group[0][0] - start_a)
+    end_b = group[-1][3] + (end_a - group[-1][1])
+    return start_a, end_a, start_b, end_b, group
+
+
+def hunk_header(start: int, length: int) -> str:
+    if length == 1:
+        return f'{start + 1}'
+    return f'{start + 1 if length else start},{length}'
+
+
+def format_line(prefix: str, line: bytes) -> str:
+    text = prefix + line.decode('utf-8', 'replace')
+    return text if text.endswith('\n') else text + '\n\\ No newline at end of file\n'
+
+
+def unified_diff(a: List[int], b: List[int], lines: List[bytes], context=3) -> Generator[str, None, None]:
+    for start_a, end_a, start_b, end_b, group in grouped_changes(histogram_diff(a, b), len(a), len(b), context):
+        yield f'@@ -{hunk_header(start_a, end_a - start_a)} +{hunk_header(start_b, end_b - start_b)} @@\n'
+        pos = start_a
+        for i1, i2, j1, j2 in group:
+            yield from (format_line(' ', lines[x]) for x in a[pos:i1])
+            yield from (format_line('-', lines[x]) for x in a[i1:i2])
+            yield from (format_line('+', lines[x]) for x in b[j1:j2])
+            pos = i2
+        yield from (format_line(' ', lines[x]) for x in a[pos:end_a])
+
+
+def file_header(path: str, old: Optional[Tuple[int, str]], new: Optional[Tuple[int, str]], with_paths=True) -> str:
+    header = f'diff --git a/{path} b/{path}\n'
+    if old is None:
+        header += f'new file mode {new[0]:o}\nindex {NULL_OID[:7]}..{new[1][:7]}\n'
+    elif new is None:
+        header += f'deleted file mode {old[0]:o}\nindex {old[1][:7]}..{NULL_OID[:7]}\n'
+    elif old[0] != new[0]:
+        header += f'old mode {old[0]:o}\nnew mode {new[0]:o}\n'
+        header += f'index {old[1][:7]}..{new[1][:7]}\n' if old[1] != new[1] else ''
+    else:
+        header += f'index {old[1][:7]}..{new[1][:7]} {old[0]:o}\n'
+    if with_paths:
+        header += '--- /dev/null\n' if old is None else f'--- a/{path}\n'
+        header += '+++ /dev/null\n' if new is None else f'+++ b/{path}\n'
+    return header
+
+
+def load_lines(chunks: Iterable[bytes], interner: LineInterner) -> Optional[List[int]]:
+    # Returns None for binary content, which is never split into lines
+    binary, chunks = peek_binary(chunks)
+    return None if binary else interner.intern(split_lines(chunks))
+
+
+def diff_lines(path: str, old: Optional[Tuple[int, str]], new: Optional[Tuple[int, str]],
+               a: Optional[List[int]], b: Optional[List[int]], lines: List[bytes], context=3) -> Generator[str, None, None]:
+    if old is not None and new is not None and old[1] == new[1]:
+        yield file_header(path, old, new, with_paths=False)  # Only the mode changed
+        return
+    if a is None or b is None:
+        yield file_header(path, old, new, with_paths=False)
+        yield f'Binary files {"/dev/null" if old is None else "a/" + path} and {"/dev/null" if new is None else "b/" + path} differ\n'
+        return
+    hunks = unified_diff(a, b, lines, context)
+    if (first := next(hunks, None)) is None:
+        if old is None or new is None or old[0] != new[0]:
+            yield file_header(path, old, new, with_paths=False)  # Empty file or mode change
+        return
+    yield file_header(path, old, new)
+    yield first
+    yield from hunks
+
+
+def diff_worktree(patterns: List[str], context=3) -> Generator[str, None, None]:
+    obj = parse_index()[0] if git_dir().joinpath('index').exists() else IndexObject()
+    obj.close()  # Only the parsed entries are needed
+    for path in sorted(obj.entries):
+        entry = obj.entries[path]
+        if not match_patterns(path, patterns):
+            continue
+        old = (normalize_mode(entry.mode), entry.hash)
+        file = Path(path)
+        interner = LineInterner()
+        if not file.is_file():
+            yield from diff_lines(path, old, None, load_lines(stream_object(entry.hash), interner), [], interner.lines, context)
+            continue
+        if entry.is_stat_clean(file):
+            continue
+
+        # Hash the worktree file while it is read, so touched but unchanged files are skipped
+        info = file.stat()
+        h = sha1()
+        chunks = hash_stream(stream_file(file), info.st_size, h)
+        b = load_lines(chunks, interner)
+        for _ in chunks:
+            pass  # Binary content is hashed but not split
+        new = (old[0] if is_windows() else normalize_mode(info.st_mode), h.hexdigest())
+        if new == old:
+            continue
+        a = load_lines(stream_object(entry.hash), interner) if new[1] != old[1] else None
+        yield from diff_lines(path, old, new, a, b, interner.lines, context)
+
+
+def diff_cached(patterns: List[str], context=3) -> Generator[str, None, None]:
+    obj = parse_index()[0] if git_dir().joinpath('index').exists() else IndexObject()
+    obj.close()  # Only the parsed entries are needed
+    tree = {path: (normalize_mode(mode), oid) for path, (mode, oid) in tree_entries('HEAD').items()}
+    staged = {path: (normalize_mode(entry.mode), entry.hash) for path, entry in obj.entries.items()}
+    for path in sorted(tree.keys() | staged.keys()):
+        old, new = tree.get(path), staged.get(path)
+        if old == new or not match_patterns(path, patterns):
+            continue
+        interner = LineInterner()
+        if old is not None and new is not None and old[1] == new[1]:
+            yield from diff_lines(path, old, new, None, None, interner.lines, context)
+            continue
+        a = load_lines(stream_object(old[1]), interner) if old else []
+        b = load_lines(stream_object(new[1]), interner) if new else []
+        yield from diff_lines(path, old, new, a, b, interner.lines, context)
+
+
+def diff(patterns: List[str], cached=False, context=3) -> None:
+    for text in (diff_cached if cached else diff_worktree)(patterns, context):
+        sys.stdout.write(text)
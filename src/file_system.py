@@ -3,8 +3,9 @@ from pathlib import Path
 from data_objects import GIT_DIR
 import os
 import re
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Generator, List
+from typing import BinaryIO, Generator, List
 
 from data_objects import GIT_DIR
 from gitignore_parser import parse_gitignore
@@ -72,6 +73,31 @@ def get_git_dir(path) -> Path:
         return get_git_dir(up_one_level(path))
 
 
+@contextmanager
+def lock_file(path: Path) -> Generator[BinaryIO, None, None]:
+    """Write path through '<path>.lock' as Git does.
+
+    The lock is created exclusively, so a concurrent writer fails instead of
+    interleaving, and it is renamed over path only once fully written.
+    """
+    lock = path.with_name(path.name + '.lock')
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    except FileExistsError:
+        raise FileExistsError(f"Unable to create '{lock}': File exists.\n"
+                              'Another git process seems to be running in this repository. '
+                              'If it crashed, remove the file manually to continue.') from None
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(lock, path)
+    except BaseException:
+        lock.unlink(missing_ok=True)
+        raise
+
+
 def make_base_dirs() -> None:
     g = git_dir()
     print('@', g)
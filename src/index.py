@@ -1,12 +1,15 @@
+import mmap
 import struct
 import zlib
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from hashlib import sha1
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Tuple, Union
+from typing import Any, BinaryIO, Dict, Generator, List, Tuple, Union
 from binascii import unhexlify
 from common import is_windows
-from file_system import git_dir, glob
+from data_objects import DataType
+from file_system import git_dir, glob, lock_file
 
 
 # @dataclass
@@ -41,8 +44,10 @@ class IndexEntry():
     skip_worktree_flag: int = None
     intent_to_add_flag: int = None
     filename: str = None
+    # Bytes of this entry in IndexObject.source, reused as is on write; reset it when changing the entry in place
+    span: Tuple[int, int] = field(default=None, repr=False, compare=False)
 
-    def from_file(self, file: Path, assume_unchanged=False, index_version=0, skip_worktree_flag=0, intent_to_add_flag=0) -> None:
+    def from_file(self, file: Path, assume_unchanged=False, index_version=0, skip_worktree_flag=0, intent_to_add_flag=0, oid=None) -> None:
         info = file.stat()
         self.ctime = int(info.st_ctime)
         self.ctime_ns = info.st_ctime_ns % 1_000_000_000
@@ -54,16 +59,27 @@ class IndexEntry():
         self.uid = 0 if is_windows() else info.st_uid
         self.gid = 0 if is_windows() else info.st_gid
         self.size = info.st_size
-        with file.open(mode='rb') as f:
-            self.hash, _ = hash_object(f.read().decode())
+        if oid:
+            self.hash = oid  # Content was just written from this object
+        else:
+            with file.open(mode='rb') as f:
+                self.hash, _ = hash_object(f.read().decode())
 
         self.assume_flag = 0b0 if not assume_unchanged else 0b1  # Default 0
         self.extended_flag = 0b0 if index_version < 3 else 0b1  # Default 0
         self.skip_worktree_flag = skip_worktree_flag if self.extended_flag else 0b0
         self.intent_to_add_flag = intent_to_add_flag if self.extended_flag else 0b0
         self.filename = file.name
+        self.span = None
         return self
 
+    def is_stat_clean(self, file: Path) -> bool:
+        info = file.stat()
+        return (self.size == info.st_size and
+                self.mtime == int(info.st_mtime) and self.mtime_ns == info.st_mtime_ns % 1_000_000_000 and
+                self.ctime == int(info.st_ctime) and self.ctime_ns == info.st_ctime_ns % 1_000_000_000 and
+                (is_windows() or self.ino == info.st_ino))
+
     def binary_data(self) -> bytes:
         optional_flag = (self.assume_flag << 15) | (self.extended_flag << 14)
         flag = optional_flag | len(self.filename)
@@ -89,11 +105,14 @@ class IndexObject():
     entry_num: int = 0
     entries: Dict[str, IndexEntry] = None
 
-    def __init__(self, data_type: str = 'DIRC', version: int = 2, entries=None) -> None:
+    source: mmap.mmap = field(default=None, repr=False, compare=False)  # Previous index, for reusing entries
+
+    def __init__(self, data_type: str = 'DIRC', version: int = 2, entries=None, source=None) -> None:
         self.data_type = data_type
         self.version = version
         self.entries = entries if entries else {}
         self.entry_num = len(entries) if self.entries else 0
+        self.source = source
     #     self.header = index_header(len(files))
     #     self.entries = [index_entry(file) for file in files]
 
@@ -101,11 +120,42 @@ class IndexObject():
         self.entries[file.name] = IndexEntry().from_file(file)
         self.entry_num = len(self.entries)
 
+    def binary_chunks(self) -> Generator[bytes, None, None]:
+        yield struct.pack('>4sII', self.data_type.encode(), self.version, len(self.entries))
+        # Unchanged entries are copied from the previous index, in runs of adjacent entries.
+        # The index format requires entries sorted by name
+        start = end = None
+        for _, entry in sorted(self.entries.items()):
+            if self.source is not None and entry.span is not None and entry.span[0] == end:
+                end = entry.span[1]
+                continue
+            if start is not None:
+                yield self.source[start:end]
+            if self.source is not None and entry.span is not None:
+                start, end = entry.span
+            else:
+                start = end = None
+                yield entry.binary_data()
+        if start is not None:
+            yield self.source[start:end]
+
     def binary_data(self) -> bytes:
-        data = struct.pack('>4sII', self.data_type.encode(), self.version, len(self.entries)) + \
-            b''.join([entry.binary_data() for entry in self.entries.values()])
+        data = b''.join(self.binary_chunks())
         return data + bytes.fromhex(sha1(data).hexdigest())
 
+    def write(self, f: BinaryIO) -> None:
+        h = sha1()
+        for chunk in self.binary_chunks():
+            h.update(chunk)
+            f.write(chunk)
+        f.write(h.digest())
+
+    def close(self) -> None:
+        # The previous index must be unmapped before it is replaced (required on Windows)
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
 
 def write_object(data: str) -> str:
     oid, obj = hash_object(data)
@@ -116,31 +166,91 @@ def write_object(data: str) -> str:
     return oid
 
 
+def hash_file(file: Path, chunksize=65536) -> str:
+    h = sha1(f'blob {file.stat().st_size}\x00'.encode())
+    with file.open(mode='rb') as f:
+        while (chunk := f.read(chunksize)):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def normalize_mode(mode: int) -> int:
+    # Git only records 100755 or 100644 for regular files
+    if mode & 0o170000 != 0o100000:
+        return mode
+    return 0o100755 if mode & 0o111 else 0o100644
+
+
 def hash_object(data: str, obj_type: str = 'blob') -> Tuple[str, bytes]:
     obj = f'{obj_type} {len(data)}\x00{data}'.encode()
     oid = sha1(obj).hexdigest()
     return oid, obj
 
 
-def update_ref(ref: str, value: str):
+def read_object(oid: str) -> Tuple[str, bytes]:
+    with git_dir().joinpath('objects', oid[:2], oid[2:]).open('rb') as f:
+        obj = zlib.decompress(f.read())
+    header, _, data = obj.partition(b'\x00')
+    obj_type, _ = header.decode().split(' ')
+    return obj_type, data
+
+
+def stream_object(oid: str, chunksize=65536) -> Generator[bytes, None, None]:
+    # Inflates the object piece by piece, without the '<type> <size>\x00' header
+    d = zlib.decompressobj()
+    header = b''
+    with git_dir().joinpath('objects', oid[:2], oid[2:]).open('rb') as f:
+        while (chunk := f.read(chunksize)):
+            data = d.decompress(chunk)
+            if header is not None:
+                header += data
+                if b'\x00' not in header:
+                    continue
+                _, _, data = header.partition(b'\x00')
+                header = None
+            if data:
+                yield data
+    data = d.flush()
+    if header is not None:
+        _, _, data = (header + data).partition(b'\x00')
+    if data:
+        yield data
+
+
+def read_tree(oid: str, prefix: str = '') -> Generator[Tuple[str, int, str], None, None]:
+    obj_type, data = read_object(oid)
+    if obj_type != DataType.TREE.value:
+        raise ValueError(f'{oid} is not a tree object')
+    pos = 0
+    while pos < len(data):
+        end = data.index(b'\x00', pos)
+        mode, name = data[pos:end].decode().split(' ', 1)
+        mode = int(mode, 8)
+        entry_oid = data[end + 1:end + 21].hex()
+        pos = end + 21
+        if mode & 0o170000 == 0o040000:
+            yield from read_tree(entry_oid, f'{prefix}{name}/')
+        elif mode & 0o170000 != 0o160000:  # Skip submodules
+            yield f'{prefix}{name}', mode, entry_oid
+
+
+def update_ref(ref: str, value: str, symbolic=True):
     print('@ update_ref', value)
-    with open(git_dir().joinpath(ref), 'w') as f:
-        f.write(f'ref: {value}')
+    with lock_file(git_dir().joinpath(ref)) as f:
+        f.write(f'ref: {value}'.encode() if symbolic else f'{value}\n'.encode())  # Detached: a plain oid
 
 
 def add(patterns: List[str]) -> None:
-    
-    obj = parse_index()[0] if git_dir().joinpath('index').exists() else IndexObject()
-    for path in glob(patterns):
-        # path = Path(file)
-        if not path.exists():
-            print(f'@File not found ({path})')
-            continue
-        with path.open(mode='r') as f:
-            data = f.read()
-        write_object(data)
-        obj.update(path)
-    update_index(obj)
+    with locked_index() as obj:
+        for path in glob(patterns):
+            # path = Path(file)
+            if not path.exists():
+                print(f'@File not found ({path})')
+                continue
+            with path.open(mode='r') as f:
+                data = f.read()
+            write_object(data)
+            obj.update(path)
 
 def reset_add(patterns: List[str]) -> None:
     update_index(IndexObject())
@@ -148,51 +258,66 @@ def reset_add(patterns: List[str]) -> None:
 def update_index(obj: IndexObject) -> None:
     print(obj)
     print('@ update_index')
-    with git_dir().joinpath('index').open(mode='wb') as f:
-        f.write(obj.binary_data())
+    with lock_file(git_dir().joinpath('index')) as f:
+        obj.write(f)
+        obj.close()
+
+
+@contextmanager
+def locked_index() -> Generator[IndexObject, None, None]:
+    """Hold index.lock while the index is read, modified and written back."""
+    with lock_file(git_dir().joinpath('index')) as f:
+        obj = parse_index()[0] if git_dir().joinpath('index').exists() else IndexObject()
+        try:
+            yield obj
+            print(obj)
+            print('@ update_index')
+            obj.write(f)
+        finally:
+            obj.close()
 
 
 def parse_index() -> Tuple[IndexObject, str]:
     with git_dir().joinpath('index').open(mode='rb') as f:
-
-        def read(format: str) -> Union[Tuple, Any]:
-            d = struct.unpack(format, f.read(struct.calcsize(format)))
-            return d if len(d) else d[0]
-
-        data_type, version, entry_num = read('>4sII')
-        entries = {}
-        for _ in range(entry_num):
-            format = '>IIIIIIIIII20sH'
-            entry_size = struct.calcsize(format)
-            ct, ctns, mt, mtns, dev, ino, mode, uid, gid, size, hash, flag = read(format)
-            asmflg = (flag >> 15) & 0x01
-            extflg = (flag >> 14) & 0x01
-            if extflg:
-                extoptflg = read('>H')
-                rsvflg = (extoptflg >> 15) & 0x01
-                skpflg = (extoptflg >> 14) & 0x01
-                addflg = (extoptflg >> 13) & 0x01
-            else:
-                rsvflg = skpflg = addflg = 0
-            fname = ''
-            if (fn_len := int(flag & 0xFFF)) < 0xFFF:
-                fname = f.read(fn_len)
-                entry_size += fn_len
-            else:
-                while (char := f.read(1)) != b'\x00':
-                    fname += char
-                    entry_size += 1
-
-            f.read((8 - (entry_size % 8)) or 8)
-            entries[fname.decode()] = IndexEntry(ct, ctns, mt, mtns, dev, ino, mode, uid, gid,
-                                         size, hash.hex(), asmflg, extflg, rsvflg, skpflg, addflg,
-                                         fname.decode("utf-8", "replace"))
-
-        obj = IndexObject(data_type.decode(), version, entries)
-        index_hash = read('20s')
-        print('@', obj)
-        print('@', index_hash[0].hex())
-        return obj, index_hash[0].hex()
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    pos = 0
+
+    def read(format: str) -> Union[Tuple, Any]:
+        nonlocal pos
+        d = struct.unpack_from(format, source, pos)
+        pos += struct.calcsize(format)
+        return d if len(d) > 1 else d[0]
+
+    data_type, version, entry_num = read('>4sII')
+    entries = {}
+    for _ in range(entry_num):
+        start = pos
+        ct, ctns, mt, mtns, dev, ino, mode, uid, gid, size, hash, flag = read('>IIIIIIIIII20sH')
+        asmflg = (flag >> 15) & 0x01
+        extflg = (flag >> 14) & 0x01
+        if extflg:
+            extoptflg = read('>H')
+            rsvflg = (extoptflg >> 15) & 0x01
+            skpflg = (extoptflg >> 14) & 0x01
+            addflg = (extoptflg >> 13) & 0x01
+        else:
+            rsvflg = skpflg = addflg = 0
+        if (fn_len := int(flag & 0xFFF)) < 0xFFF:
+            fname = source[pos:pos + fn_len]
+        else:
+            fname = source[pos:source.find(b'\x00', pos)]
+        pos += len(fname)
+
+        pos += (8 - ((pos - start) % 8)) or 8
+        entries[fname.decode()] = IndexEntry(ct, ctns, mt, mtns, dev, ino, mode, uid, gid,
+                                             size, hash.hex(), asmflg, extflg, rsvflg, skpflg, addflg,
+                                             fname.decode("utf-8", "replace"), (start, pos))
+
+    obj = IndexObject(data_type.decode(), version, entries, source)
+    index_hash = read('20s')
+    print('@', obj)
+    print('@', index_hash.hex())
+    return obj, index_hash.hex()
 
 
 if __name__ == "__main__":
@@ -3,8 +3,10 @@ import pathlib
 import sys
 
 import data_objects
+import diff
 import file_system
 import index
+import worktree
 
 __version__ = '0.0.1'
 
@@ -28,11 +30,40 @@ def command_status(args):
 
 def command_add(args):
     print('@', sys._getframe().f_code.co_name)
-    index.add(args.patterns)
+    try:
+        index.add(args.patterns)
+    except FileExistsError as e:
+        sys.exit(f'fatal: {e}')
 
 def command_reset(args):
     print('@', sys._getframe().f_code.co_name)
-    index.reset_add(args.patterns)
+    try:
+        index.reset_add(args.patterns)
+    except FileExistsError as e:
+        sys.exit(f'fatal: {e}')
+
+def command_checkout(args):
+    print('@', sys._getframe().f_code.co_name)
+    try:
+        worktree.checkout(args.rev, workers=args.workers)
+    except FileExistsError as e:
+        sys.exit(f'fatal: {e}')
+    except ValueError as e:
+        sys.exit(str(e))
+
+def command_restore(args):
+    print('@', sys._getframe().f_code.co_name)
+    try:
+        worktree.restore(args.patterns, source=args.source, staged=args.staged, worktree=args.worktree,
+                         workers=args.workers)
+    except FileExistsError as e:
+        sys.exit(f'fatal: {e}')
+    except ValueError as e:
+        sys.exit(str(e))
+
+def command_diff(args):
+    print('@', sys._getframe().f_code.co_name)
+    diff.diff(args.patterns, cached=args.cached, context=args.unified)
 
 def command_commit(args):
     print('@', sys._getframe().f_code.co_name)
@@ -73,6 +104,25 @@ def argment_parser() -> argparse.ArgumentParser:
     parser_reset.set_defaults(handler=command_reset)
     parser_reset.add_argument('patterns', nargs='*', default="-")
 
+    parser_checkout = commands.add_parser('checkout')
+    parser_checkout.add_argument('-j', '--workers', type=int, default=0, help='parallel workers (0: one per CPU)')
+    parser_checkout.set_defaults(handler=command_checkout)
+    parser_checkout.add_argument('rev')
+
+    parser_restore = commands.add_parser('restore')
+    parser_restore.add_argument('-s', '--source', metavar='tree-ish', help='restore from a tree (default: index, or HEAD with --staged)')
+    parser_restore.add_argument('-S', '--staged', action='store_true', help='restore the index')
+    parser_restore.add_argument('-W', '--worktree', action='store_true', help='restore the worktree (default without --staged)')
+    parser_restore.add_argument('-j', '--workers', type=int, default=0, help='parallel workers (0: one per CPU)')
+    parser_restore.set_defaults(handler=command_restore)
+    parser_restore.add_argument('patterns', nargs='+')
+
+    parser_diff = commands.add_parser('diff')
+    parser_diff.add_argument('--cached', '--staged', action='store_true', help='compare the index with HEAD')
+    parser_diff.add_argument('-U', '--unified', type=int, default=3, metavar='n', help='lines of context')
+    parser_diff.set_defaults(handler=command_diff)
+    parser_diff.add_argument('patterns', nargs='*', default=[])
+
     parser_commit = commands.add_parser('commit')
     parser_commit.add_argument('-m', metavar='msg', help='commit message')
     parser_commit.set_defaults(handler=command_commit)
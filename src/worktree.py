@@ -0,0 +1,202 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from common import is_windows
+from data_objects import GIT_DIR, DataType
+from file_system import git_dir
+from index import IndexEntry, hash_file, locked_index, normalize_mode, read_object, read_tree, update_ref
+
+
+def resolve_ref(name: str) -> Optional[str]:
+    # Only HEAD and files under refs/ are refs, never other files in the git dir
+    refs = [name] if name == 'HEAD' or name.startswith('refs/') else [f'refs/heads/{name}', f'refs/tags/{name}']
+    for ref in refs:
+        file = git_dir().joinpath(ref)
+        if '..' not in Path(ref).parts and file.is_file():
+            value = file.read_text().strip()
+            return resolve_ref(value[5:]) if value.startswith('ref: ') else value
+    return None
+
+
+def resolve_rev(rev: str) -> str:
+    oid = resolve_ref(rev) or rev
+    if not re.fullmatch('[0-9a-f]{40}', oid) or not git_dir().joinpath('objects', oid[:2], oid[2:]).is_file():
+        raise ValueError(f'fatal: invalid reference: {rev}')
+    return oid
+
+
+def resolve_tree(rev: str) -> str:
+    oid = resolve_rev(rev)
+    obj_type, data = read_object(oid)
+    if obj_type == DataType.COMMIT.value:
+        # The first line of a commit object is 'tree <oid>'
+        oid = data.split(b'\n', 1)[0].split(b' ')[1].decode()
+    return oid
+
+
+def is_safe_path(path: str) -> bool:
+    parts = Path(path).parts
+    return not Path(path).is_absolute() and '..' not in parts and GIT_DIR not in parts
+
+
+def match_patterns(path: str, patterns: List[str]) -> bool:
+    if not patterns:
+        return True
+    for pattern in patterns:
+        pattern = Path(os.path.normpath(pattern)).as_posix() if pattern else '.'
+        if pattern == '.' or path == pattern or fnmatch(path, pattern) or path.startswith(pattern + '/'):
+            return True
+    return False
+
+
+def remove_file(path: str) -> None:
+    # Parent directories left empty are removed too, as Git does
+    file = Path(path)
+    if not is_safe_path(path) or not file.is_file():
+        return
+    file.unlink()
+    for parent in file.parents:
+        if parent == Path('.') or any(parent.iterdir()):
+            break
+        parent.rmdir()
+
+
+def checkout_entry(target: Tuple[str, int, str]) -> IndexEntry:
+    path, mode, oid = target
+    obj_type, data = read_object(oid)
+    if obj_type != DataType.BLOB.value:
+        raise ValueError(f'{oid} is not a blob object ({path})')
+    file = Path(path)
+    with file.open(mode='wb') as f:
+        f.write(data)
+    if not is_windows():
+        file.chmod(0o755 if mode & 0o111 else 0o644)
+    entry = IndexEntry().from_file(file, oid=oid)
+    entry.filename = path
+    return entry
+
+
+def checkout_entries(targets: List[Tuple[str, int, str]], workers: int = 0) -> Dict[str, IndexEntry]:
+    """Inflate and write blobs into the worktree, returning the refreshed index entries.
+
+    Like Git's checkout.workers, a value below 1 uses one worker per CPU and 1 runs serially.
+    """
+    for path, _, _ in targets:
+        if not is_safe_path(path):
+            raise ValueError(f'Refusing to check out unsafe path ({path})')
+    # Directories are created up front so workers never race on the same parent
+    for parent in sorted({Path(path).parent for path, _, _ in targets}):
+        parent.mkdir(parents=True, exist_ok=True)
+
+    workers = workers if workers >= 1 else os.cpu_count() or 1
+    if workers == 1 or len(targets) < 2:
+        entries = list(map(checkout_entry, targets))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(checkout_entry, targets))
+    return {entry.filename: entry for entry in entries}
+
+
+def raise_local_changes(dirty: List[str], untracked: List[str]) -> None:
+    if dirty:
+        files = ''.join(f'\t{path}\n' for path in dirty)
+        raise ValueError('error: Your local changes to the following files would be overwritten by checkout:\n'
+                         f'{files}Please commit your changes or stash them before you switch branches.\nAborting')
+    if untracked:
+        files = ''.join(f'\t{path}\n' for path in untracked)
+        raise ValueError('error: The following untracked working tree files would be overwritten by checkout:\n'
+                         f'{files}Please move or remove them before you switch branches.\nAborting')
+
+
+def checkout(rev: str, workers: int = 0) -> None:
+    """Switch the worktree and the index from HEAD's tree to rev's tree.
+
+    As in Git's two-way merge, only paths that differ between the two trees are touched;
+    staged and unstaged changes elsewhere are carried over.
+    """
+    oid = resolve_rev(rev)
+    head = {path: (normalize_mode(mode), blob) for path, (mode, blob) in tree_entries('HEAD').items()}
+    target = {path: (normalize_mode(mode), blob) for path, (mode, blob) in tree_entries(oid).items()}
+    with locked_index() as obj:
+        changed, removed, dirty, untracked = [], [], [], []
+        for path in sorted(head.keys() | target.keys()):
+            if (old := head.get(path)) == (new := target.get(path)):
+                continue
+            entry = obj.entries.get(path)
+            staged = None if entry is None else (normalize_mode(entry.mode), entry.hash)
+            if staged == new:
+                continue  # Already staged as in rev
+            file = Path(path)
+            if staged != old:
+                dirty.append(path)
+            elif entry is None:
+                if file.exists():
+                    untracked.append(path)
+            elif file.is_file() and not entry.is_stat_clean(file) and hash_file(file) != entry.hash:
+                dirty.append(path)
+            if new is None:
+                removed.append(path)
+            else:
+                changed.append((path, new[0], new[1]))
+        raise_local_changes(dirty, untracked)
+
+        entries = checkout_entries(changed, workers)
+        for path in removed:
+            remove_file(path)
+            del obj.entries[path]
+        obj.entries.update(entries)
+        obj.entry_num = len(obj.entries)
+    if resolve_ref(f'refs/heads/{rev}') is not None:
+        update_ref('HEAD', f'refs/heads/{rev}')
+    elif rev != 'HEAD':
+        update_ref('HEAD', oid, symbolic=False)
+
+
+def tree_entries(rev: str) -> Dict[str, Tuple[int, str]]:
+    if rev == 'HEAD' and resolve_ref('HEAD') is None:
+        return {}  # No commit yet
+    return {path: (mode, oid) for path, mode, oid in read_tree(resolve_tree(rev))}
+
+
+def restore(patterns: List[str], source: str = None, staged: bool = False, worktree: bool = False, workers: int = 0) -> None:
+    """Like 'git restore': the worktree is restored by default, --staged restores only the index and
+    both restore both. The source defaults to the index for the worktree and to HEAD with --staged.
+    """
+    if not patterns:
+        raise ValueError('fatal: you must specify path(s) to restore')
+    worktree = worktree or not staged
+    if staged and source is None:
+        source = 'HEAD'
+
+    with locked_index() as obj:
+        tracked = [path for path in obj.entries if match_patterns(path, patterns)]
+        if source is None:
+            targets = {path: (obj.entries[path].mode, obj.entries[path].hash) for path in tracked}
+        else:
+            targets = {path: value for path, value in tree_entries(source).items() if match_patterns(path, patterns)}
+        if not targets and not tracked:
+            raise ValueError(f"error: pathspec '{' '.join(patterns)}' did not match any file(s) known to git")
+        removed = [path for path in tracked if path not in targets]
+
+        entries = {}
+        if worktree:
+            entries = checkout_entries([(path, mode, oid) for path, (mode, oid) in targets.items()], workers)
+            for path in removed:
+                remove_file(path)
+        if source is None:
+            obj.entries.update(entries)  # Same content as the index, only the stat data is refreshed
+        elif staged:
+            for path in removed:
+                del obj.entries[path]
+            for path, (mode, oid) in targets.items():
+                entry = obj.entries.get(path)
+                if path in entries:
+                    obj.entries[path] = entries[path]
+                elif entry is None or entry.hash != oid or normalize_mode(entry.mode) != normalize_mode(mode):
+                    # Not in the worktree, so there is no stat data to record yet
+                    obj.entries[path] = IndexEntry(0, 0, 0, 0, 0, 0, mode, 0, 0, 0, oid, 0, 0, 0, 0, 0, path)
+        obj.entry_num = len(obj.entries)